@@ -5,57 +5,58 @@ See: https://github.com/maria-antoniak/goodreads-scraper/blob/master/get_books.p
 """
 
 import argparse
+import gc
+import hashlib
+import html
 import io
 import json
+import re
 import sys
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from dataclasses import asdict, dataclass
 from datetime import datetime
-from functools import cached_property, partial
+from email.utils import parsedate_to_datetime
+from functools import lru_cache, partial
 from itertools import count, takewhile
 from pathlib import Path
-from typing import Any, Iterable, Union
-from xml.dom.minidom import Document, Element, Text
-from xml.dom.pulldom import parse
+from typing import Any, BinaryIO
 
+import msgpack
 import requests
 import ruamel.yaml
-from bs4 import BeautifulSoup
-
-
-@dataclass
-class Event:
-    status: str
-    node: Union[Document, Element, Text]
-
-    @cached_property
-    def name(self) -> str:
-        return self.node.nodeName
-
-    @cached_property
-    def value(self) -> str:
-        return self.node.nodeValue
-
-    @cached_property
-    def is_text(self) -> bool:
-        return self.status == "CHARACTERS"
-
-    @cached_property
-    def is_start(self) -> bool:
-        return self.status == "START_ELEMENT"
-
-    @cached_property
-    def is_end(self) -> bool:
-        return self.status == "END_ELEMENT"
+from lxml import etree
+from requests.adapters import HTTPAdapter
+
+_FEED_FIELDS = frozenset(
+    (
+        "title",
+        "link",
+        "book_id",
+        "num_pages",
+        "author_name",
+        "isbn",
+        "pubDate",
+        "user_date_added",
+        "user_date_created",
+        "average_rating",
+        "book_published",
+        "book_description",
+    )
+)
+_HTML_FIELDS = frozenset(("title", "author_name", "book_description"))
+_HTML_TAG = re.compile(r"<[^>]+>")
+_NAME_TABLE = str.maketrans({"/": "-", "\\": ""})
 
 
-@dataclass
+@dataclass(slots=True)
 class Config:
     read_url: str
     want_url: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Book:
     title: str
     url: str
@@ -71,28 +72,30 @@ class Book:
     @classmethod
     def from_goodreads(cls, entry: dict[str, str]):
         return cls(
-            **{
-                "title": entry["title"],
-                "url": entry["link"],
-                "book_id": entry["book_id"],
-                "pages": to_int(entry["num_pages"]),
-                "author": entry["author_name"],
-                "isbn": entry["isbn"].strip() if entry["isbn"].strip() else None,
-                "read_date": to_date(entry["pubDate"])
-                or to_date(entry["user_date_added"])
-                or to_date(entry["user_date_created"]),
-                "rating": to_float(entry["average_rating"]),
-                "year": to_int(entry["book_published"]),
-                "description": entry["book_description"],
-            }
+            title=entry["title"],
+            url=entry["link"],
+            book_id=entry["book_id"],
+            pages=to_int(entry["num_pages"]),
+            author=entry["author_name"],
+            isbn=entry["isbn"].strip() or None,
+            read_date=to_date(
+                entry["pubDate"]
+                or entry["user_date_added"]
+                or entry["user_date_created"]
+            ),
+            rating=to_float(entry["average_rating"]),
+            year=to_int(entry["book_published"]),
+            description=entry["book_description"],
         )
 
-    @cached_property
-    def name(self, table=str.maketrans({":": "", "/": "-", "\\": ""})) -> str:
-        name = self.title
-        for delimiter in (":", "("):
-            name = name.split(delimiter, 1)[0]
-        return name.translate(table).strip()
+    @property
+    def name(self) -> str:
+        return (
+            self.title.partition(":")[0]
+            .partition("(")[0]
+            .translate(_NAME_TABLE)
+            .strip()
+        )
 
 
 def first(sequence):
@@ -100,11 +103,23 @@ def first(sequence):
         return item
 
 
+@contextmanager
+def gc_paused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+            gc.collect()
+
+
 def to_date(text: str) -> datetime | None:
     """Fri, 30 Nov 2018 07:08:00 -0800"""
     try:
-        return datetime.strptime(text, "%a, %d %b %Y %H:%M:%S %z")
-    except ValueError:
+        return parsedate_to_datetime(text)
+    except (TypeError, ValueError):
         return None
 
 
@@ -122,34 +137,35 @@ def to_float(text: str) -> float | None:
         return None
 
 
-def parse_item(events: Iterable[Event]) -> dict[str, str]:
-    first(e for e in events if e.name == "item" and e.is_start)
-    current_name = None
-    item = defaultdict(str)
-    for event in takewhile(lambda e: not (e.name == "item"), events):
-        if event.is_start:
-            current_name = event.name
-        elif event.is_text and current_name:
-            item[current_name] += event.value
-        elif event.is_end:
-            item[current_name] = BeautifulSoup(
-                item[current_name].strip(), "html.parser"
-            ).text
-            current_name = None
+def strip_html(text: str) -> str:
+    if "<" in text:
+        text = _HTML_TAG.sub("", text)
+    if "&" in text:
+        text = html.unescape(text)
+    return text
 
+
+def parse_item(element: etree._Element) -> dict[str, str]:
+    item = defaultdict(str)
+    for node in element.iterdescendants(*_FEED_FIELDS):
+        if node.text:
+            text = node.text.strip()
+            item[node.tag] = strip_html(text) if node.tag in _HTML_FIELDS else text
     return item
 
 
-def parse_list(text: str):
-    events = (Event(status, node) for status, node in parse(io.StringIO(text)))
-    for event in takewhile(lambda e: not (e.is_end and e.name == "channel"), events):
-        item = parse_item(events)
+def parse_list(source: BinaryIO):
+    for _, element in etree.iterparse(source, events=("end",), tag="item"):
+        item = parse_item(element)
+        element.clear(keep_tail=True)
+        while element.getprevious() is not None:
+            del element.getparent()[0]
         if not item.get("book_id"):
             continue
         yield Book.from_goodreads(item)
 
 
-def json_deserializer(data: dict) -> dict:
+def cache_deserializer(data: dict) -> dict:
     for field in ("read_date",):
         if date := data.get(field):
             data[field] = datetime.fromisoformat(date)
@@ -157,7 +173,7 @@ def json_deserializer(data: dict) -> dict:
 
 
 def get_cache_file(id: str, data_dir: Path) -> Path:
-    return Path(f"data/books-{id}-{datetime.now().date().isoformat()}.json")
+    return data_dir / f"books-{id}-{datetime.now().date().isoformat()}.msgpack"
 
 
 def get_cached(id: str, data_dir: Path) -> list[Book] | None:
@@ -165,9 +181,9 @@ def get_cached(id: str, data_dir: Path) -> list[Book] | None:
     if not cache.exists():
         return None
 
-    with cache.open() as stream:
+    with cache.open("rb") as stream, gc_paused():
         return [
-            Book(**book) for book in json.load(stream, object_hook=json_deserializer)
+            Book(**cache_deserializer(book)) for book in msgpack.unpackb(stream.read())
         ]
 
 
@@ -176,32 +192,90 @@ def set_cached(id: str, data_dir: Path, books: list[Book]):
     if cache.exists():
         return
 
-    with cache.open("w") as stream:
-        json.dump([asdict(book) for book in books], stream, default=str)
+    with cache.open("wb") as stream:
+        stream.write(msgpack.packb([asdict(book) for book in books], default=str))
+
+
+def get_pages_cache_file(id: str, data_dir: Path) -> Path:
+    return data_dir / f"pages-{id}.msgpack"
+
+
+def get_cached_pages(id: str, data_dir: Path) -> dict[str, dict]:
+    cache = get_pages_cache_file(id, data_dir)
+    if not cache.exists():
+        return {}
+
+    with cache.open("rb") as stream:
+        return msgpack.unpackb(stream.read())
+
+
+def set_cached_pages(id: str, data_dir: Path, pages: dict[str, dict]):
+    cache = get_pages_cache_file(id, data_dir)
+    with cache.open("wb") as stream:
+        stream.write(msgpack.packb(pages, default=str))
+
+
+def make_session() -> requests.Session:
+    session = requests.Session()
+    session.headers.update(
+        {
+            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36"
+        }
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=10))
+    return session
+
+
+_SESSION = make_session()
+
+
+def get_session() -> requests.Session:
+    return _SESSION
+
 
+def get_page(url: str, page: int, pages: dict[str, dict]) -> list[Book]:
+    key = f"{url}?page={page}"
+    headers = {}
+    if cached := pages.get(key):
+        headers["If-None-Match"] = cached["etag"]
 
-def get_page(url: str, page: int) -> list[Book]:
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36"
-    }
-    r = requests.get(url, params=dict(page=page), headers=headers)
-    return list(parse_list(r.text))
+    with get_session().get(
+        url, params=dict(page=page), headers=headers, stream=True
+    ) as r:
+        if cached and r.status_code == 304:
+            return [Book(**cache_deserializer(dict(book))) for book in cached["books"]]
+        r.raw.decode_content = True
+        books = list(parse_list(r.raw))
+
+    if etag := r.headers.get("ETag"):
+        pages[key] = {"etag": etag, "books": [asdict(book) for book in books]}
+    return books
 
 
-def get_pages(url: str) -> list[Book]:
+def get_pages(url: str, pages: dict[str, dict], batch_size: int = 8) -> list[Book]:
     all_books = []
-    for page in count(1):
-        books = get_page(url, page=page)
-        if not books:
-            break
-        all_books += books
+    with gc_paused(), ThreadPoolExecutor(max_workers=batch_size) as executor:
+        for start in count(1, batch_size):
+            batch = range(start, start + batch_size)
+            futures = {
+                executor.submit(get_page, url, page, pages): page for page in batch
+            }
+            results = {
+                futures[future]: future.result() for future in as_completed(futures)
+            }
+            for page in batch:
+                if not results[page]:
+                    return all_books
+                all_books += results[page]
     return all_books
 
 
 def get_list(url: str, id: str, data_dir: Path) -> list[Book]:
     if cached := get_cached(id, data_dir):
         return cached
-    books = get_pages(url)
+    pages = get_cached_pages(id, data_dir)
+    books = get_pages(url, pages)
+    set_cached_pages(id, data_dir, pages)
     set_cached(id, data_dir, books)
     return books
 
@@ -224,6 +298,7 @@ def write_ratings_list(books: list[Book], path: Path, dir: Path):
             )
 
 
+@lru_cache(maxsize=1)
 def make_yaml_parser() -> ruamel.yaml.YAML:
     yaml = ruamel.yaml.YAML(typ="safe")
     yaml.default_flow_style = False
@@ -255,14 +330,9 @@ def extract_yaml_doc(path: Path) -> dict:
 
 
 def extract_file_text(path: Path) -> str:
-    separator = "----\n"
     all_text = path.read_text()
-    if not separator in all_text:
-        return all_text
-    with path.open() as stream:
-        markers = "\n".join(takewhile(lambda line: line != separator, stream))
-        text = stream.read().strip()
-    return text
+    _, separator, text = all_text.partition("----\n")
+    return text.strip() if separator else all_text
 
 
 def save_file(data: dict[str, Any], markers: str, path: Path):
@@ -273,14 +343,24 @@ def save_file(data: dict[str, Any], markers: str, path: Path):
         text = extract_file_text(path)
 
     data = previous_header | data
+    if data == previous_header:
+        return
 
-    with path.open("w") as stream:
-        yaml = make_yaml_parser()
-        yaml.dump(data, stream)
-        print("---", file=stream, end="\n\n")
-        print(markers, file=stream, end="\n\n")
-        print(f"----\n", file=stream)
-        print(text, file=stream)
+    stream = io.StringIO()
+    make_yaml_parser().dump(data, stream)
+    stream.write(f"---\n\n{markers}\n\n----\n\n{text}\n")
+    path.write_text(stream.getvalue())
+
+
+def get_render_hashes_file(data_dir: Path) -> Path:
+    return data_dir / ".render_hashes.json"
+
+
+def render_hash(data: dict[str, Any], markers: str, path: Path) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps([data, markers], sort_keys=True, default=str).encode())
+    digest.update(str(path.stat().st_mtime_ns).encode())
+    return digest.hexdigest()
 
 
 def print_list(url: str, id: str, args):
@@ -295,13 +375,19 @@ def print_list(url: str, id: str, args):
 def render_list(url: str, name: str, id: str, args):
     books = get_list(url, id, args.data_dir)
     write_ratings_list(books, args.listas_dir / name, args.books_dir)
+    hashes_file = get_render_hashes_file(args.data_dir)
+    hashes = json.loads(hashes_file.read_text()) if hashes_file.exists() else {}
     for book in books:
         path = args.books_dir / (book.name + ".md")
         if path.exists():
             book_data = asdict(book)
             book_data["author"] = f"[[Autores/{book.author}|{book.author}]]"
             book_data["read_date"] = book.read_date.date().isoformat()
+            if hashes.get(str(path)) == render_hash(book_data, "#libro", path):
+                continue
             save_file(book_data, "#libro", path)
+            hashes[str(path)] = render_hash(book_data, "#libro", path)
+    hashes_file.write_text(json.dumps(hashes))
 
 
 def list_read_command(args):